@@ -12,17 +12,65 @@ Usage: bcli <command> [<args>]
        bcli install-bash-completion # Install bash completion script
        bcli [TAB] [TAB] # Provide bash completion
 """
-import argparse
-import select
-import subprocess
+import atexit
 import os
 import sys
-import yaml
-import argcomplete  # Add import for argcomplete
 import re
-import tempfile
+import shlex
 import json
-import traceback
+from collections import ChainMap
+
+def _yaml():
+    # PyYAML is slow to import, only pay for it when metadata.yaml actually
+    # needs to be parsed
+    import yaml
+    # CSafeLoader is only there when PyYAML was built with libyaml
+    return yaml, getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Patterns for global and function-specific annotations in bash files
+_GLOBAL_ANNOTATION_RE = re.compile(r"#bcli:\s+(\w+)\s+(.*)")
+_FUNCTION_RE = re.compile(r"^\s*(\w+)\s*\(\s*\)\s*\{")
+_FUNCTION_HEADER_RE = re.compile(r"^\s*(\w+)\s*\(\s*\)\s*$")
+_FUNC_ANNOTATION_RE = re.compile(r"#bcli:func\s+(\w+)\s+(.*)")
+# "source file" / ". file" lines
+_INCLUDE_RE = re.compile(rb"^\s*(?:\.|source)\s+([^\s;]+)", re.MULTILINE)
+
+# Parsed metadata files, path -> (_metadata_key(), metadata)
+_META_CACHE = {}
+
+# Scanned bash files, path -> (_metadata_key(), (global_annotations, functions))
+# includes are not cached, they depend on other files
+_SCAN_CACHE = {}
+
+def _metadata_key(st):
+    # Metadata files are replaced on write, so the inode changes as well
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _intern_metadata(metadata):
+    # Namespace and file names are looked up over and over by completion
+    return {sys.intern(ns): {sys.intern(fname): fpath for fname, fpath in files.items()}
+            for ns, files in metadata.items()}
+
+def _copy_metadata(metadata):
+    return {ns: dict(files) for ns, files in metadata.items()}
+
+def _bash_files(dir_path):
+    # Same order as os.walk(): the files of a directory, then its
+    # subdirectories, symlinked directories aren't followed. The directory
+    # entries already know their type, no stat() per file.
+    subdirs = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif entry.name.endswith(".sh"):
+                    yield entry
+    except OSError:
+        return
+    for subdir in subdirs:
+        yield from _bash_files(subdir)
 
 class Pybcli:
     def __init__(self, home_dir=None, sys_dir=None):
@@ -30,6 +78,10 @@ class Pybcli:
         self.sys_dir = sys_dir or "/etc/pybcli"
         self.home_metadata_file = os.path.join(self.home_dir, "metadata.yaml")
         self.sys_metadata_file = os.path.join(self.sys_dir, "metadata.yaml")
+        self.scan_cache_file = os.path.join(self.home_dir, "scan_cache.json")
+        self._ssh_masters = {}
+        self._scan_cache_keys = None  # path -> key, the entries scan_cache_file gets
+        self._scan_cache_dirty = False
 
     def _reslove_name_space(self, path, namespace):
         if namespace and namespace != "":
@@ -48,37 +100,142 @@ class Pybcli:
         metadata = self.load_metadata(is_sys=(location == "sys"))
         print(f"Importing '{path}' into namespace '{namespace}' at '{metadata_file}'")
         namespace = self._reslove_name_space(path, namespace)
-        if namespace not in metadata:
-            metadata[namespace] = {}
+        # Only rewrite the metadata file when the import actually changes it
+        updated = namespace not in metadata
+        files = metadata.setdefault(namespace, {})
 
         if os.path.isdir(path):
-            # Import all bash files in the directory
-            for root, _, files in os.walk(path):
-                for file in files:
-                    if file.endswith(".sh"):
-                        file_path = os.path.join(root, file)
-                        fname = os.path.splitext(os.path.basename(file_path))[0]
-                        metadata[namespace][fname] = os.path.abspath(file_path)
-                        print(f"File '{os.path.abspath(file_path)}' has been successfully imported into namespace '{namespace}/{fname}'")
+            # Import all bash files in the directory, walking the absolute
+            # path gives absolute roots, and report them all at once
+            imported = []
+            for entry in _bash_files(os.path.abspath(path)):
+                file_path = entry.path
+                fname = entry.name[:-3]
+                if files.get(fname) != file_path:
+                    files[fname] = file_path
+                    updated = True
+                imported.append(f"File '{file_path}' has been successfully imported into namespace '{namespace}/{fname}'\n")
+            sys.stdout.write("".join(imported))
         else:
             # Import a single file
+            file_path = os.path.abspath(path)
             fname = os.path.splitext(os.path.basename(path))[0]
-            metadata[namespace][fname] = os.path.abspath(path)
-            print(f"File '{os.path.abspath(path)}' has been successfully imported into namespace '{namespace}/{fname}'")
+            if files.get(fname) != file_path:
+                files[fname] = file_path
+                updated = True
+            print(f"File '{file_path}' has been successfully imported into namespace '{namespace}/{fname}'")
 
-        with open(metadata_file, 'w') as mf:
-            yaml.safe_dump(metadata, mf)
-            mf.close()
+        if not updated:
+            print(f"Metadata for namespace '{namespace}' at '{metadata_file}' is already up to date")
+            return
+        self._dump_metadata(metadata_file, metadata)
         print(f"Metadata updated for namespace '{namespace}' at '{metadata_file}'")
 
+    def _get_metadata(self, metadata_file, copy=True):
+        # Keep parsed metadata in process for as long as the file is unchanged,
+        # hand out copies since callers modify the namespaces in place, unless
+        # the caller only reads it
+        try:
+            st = os.stat(metadata_file)
+        except FileNotFoundError:
+            return {}
+        key = _metadata_key(st)
+        cached = _META_CACHE.get(metadata_file)
+        if not cached or cached[0] != key:
+            cached = (key, _intern_metadata(self._load_metadata(metadata_file, st)))
+            _META_CACHE[metadata_file] = cached
+        return _copy_metadata(cached[1]) if copy else cached[1]
+
+    def _load_metadata(self, metadata_file, st):
+        # Everything we write is JSON, which is valid YAML, parse it as such
+        # and only fall back to PyYAML for hand written or older files
+        with open(metadata_file, 'rb') as mf:
+            data = mf.read()
+        try:
+            return json.loads(data) or {}
+        except ValueError:
+            pass
+
+        # YAML parsing is slow, keep a JSON copy of the parsed metadata next to
+        # the YAML file and use it for as long as the YAML file is unchanged
+        stamp = "# mtime:{} size:{} ino:{}\n".format(*_metadata_key(st)).encode()
+        cache_file = metadata_file + ".json"
+        try:
+            # json takes bytes, skip the text layer
+            with open(cache_file, 'rb') as cf:
+                if cf.readline() == stamp:
+                    return json.load(cf)
+        except (OSError, ValueError):
+            pass
+
+        yaml, loader = _yaml()
+        # Hand libyaml the raw bytes in one go, it does its own UTF-8 decoding
+        metadata = yaml.load(data, Loader=loader) or {}
+        self._dump_metadata_cache(metadata_file, st, metadata)
+        return metadata
+
+    def _dump_metadata_cache(self, metadata_file, st, metadata):
+        cache_file = metadata_file + ".json"
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'w') as cf:
+                cf.write("# mtime:{} size:{} ino:{}\n".format(*_metadata_key(st)) + json.dumps(metadata))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            # e.g. sys metadata loaded by a non root user, just don't cache it
+            pass
+
+    def _dump_metadata(self, metadata_file, metadata):
+        # The metadata is a plain dict of dicts of strings, JSON is valid YAML
+        # for it and is much faster to emit than going through PyYAML.
+        # Write a new file and rename it over the old one so readers never see
+        # a partially written metadata file. Serialize first and write it in
+        # one go, json.dump() would write every token separately. Sync before
+        # the rename, or a crash could leave an empty file behind the new name.
+        tmp_file = f"{metadata_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as mf:
+            mf.write(json.dumps(metadata, indent=2, sort_keys=True) + "\n")
+            mf.flush()
+            os.fsync(mf.fileno())
+        os.replace(tmp_file, metadata_file)
+        # The file is JSON now, a cache left from reading it as YAML is stale
+        try:
+            os.unlink(metadata_file + ".json")
+        except FileNotFoundError:
+            pass
+        st = os.stat(metadata_file)
+        _META_CACHE[metadata_file] = (_metadata_key(st), _intern_metadata(metadata))
+        self._dump_completion_index(metadata_file, metadata)
+
+    def _dump_completion_index(self, metadata_file, metadata):
+        # Flat "namespace<TAB>file<TAB>path<TAB>functions" index next to the
+        # metadata, read by the bash completion so TAB doesn't start python.
+        # Empty namespaces get a line with empty fields.
+        index_file = os.path.join(os.path.dirname(metadata_file), "completion.idx")
+        tmp_file = f"{index_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                for ns, files in metadata.items():
+                    if not files:
+                        f.write(f"{ns}\t\t\t\n")
+                    for fname, fpath in files.items():
+                        try:
+                            functions = [func['name'] for func in self._scan_cached(fpath)[1]]
+                        except (OSError, ValueError):
+                            # Missing, unreadable or not UTF-8, a broken script
+                            # must not fail the import of every other one
+                            functions = []
+                        f.write(f"{ns}\t{fname}\t{fpath}\t{' '.join(functions)}\n")
+            os.replace(tmp_file, index_file)
+        finally:
+            try:
+                os.unlink(tmp_file)
+            except FileNotFoundError:
+                pass
+
     def load_metadata(self, is_sys = False):
         metadata_file = self.sys_metadata_file if is_sys else self.home_metadata_file
-        metadata = {}
-        if os.path.exists(metadata_file):
-            with open(metadata_file, 'r') as mf:
-                metadata = yaml.safe_load(mf) or {}
-                mf.close()
-        return metadata
+        return self._get_metadata(metadata_file)
 
     def load_all_metadata(self):
         home_metadata = self.load_metadata(is_sys=False)
@@ -91,121 +248,180 @@ class Pybcli:
                 home_metadata[ns] = files
         return home_metadata
 
+    def _metadata_view(self):
+        # Read-only view for completion: sys wins over home, only namespaces
+        # present in both are merged, the rest is looked up lazily from the
+        # cached metadata. Never mutate it, it shares the cached dicts.
+        home_metadata = self._get_metadata(self.home_metadata_file, copy=False)
+        sys_metadata = self._get_metadata(self.sys_metadata_file, copy=False)
+        if not sys_metadata:
+            # Single user installs, the missing sys file cost a single stat().
+            # This is the cached dict itself, callers only read it
+            return home_metadata
+        if not home_metadata:
+            return sys_metadata
+        merged = {ns: {**home_metadata[ns], **sys_metadata[ns]}
+                  for ns in home_metadata.keys() & sys_metadata.keys()}
+        return ChainMap(merged, sys_metadata, home_metadata)
+
+    def resolve_file(self, namespace, fname):
+        # Same precedence as load_all_metadata (sys over home), but only parse
+        # the home metadata when the file isn't found in the sys one
+        for metadata_file in (self.sys_metadata_file, self.home_metadata_file):
+            file = self._get_metadata(metadata_file, copy=False).get(namespace, {}).get(fname)
+            if file:
+                return file
+        raise FileNotFoundError(f"File '{fname}' not found in namespace '{namespace}'")
+
+    def _bash_argv(self, file, func, *args, cd=None):
+        # Execute the function from the file, locally or (joined) over ssh,
+        # after changing to cd if given
+        # args are passed as positional parameters so bash doesn't re-parse them.
+        # They are set aside before sourcing, the file's top level code must
+        # not see (or shift) the function's args.
+        # The ${a[@]+...} form keeps an empty array from tripping a sourced
+        # set -u on bash < 4.4 (macOS, EL7 hosts).
+        # The call stays in an && list, which keeps set -e from aborting inside
+        # the function and lets its own return code through.
+        cd = f"cd {shlex.quote(cd)} && " if cd else ""
+        command = (f"set -e; __bcli_args=(\"$@\"); set --; {cd}"
+                   f"source {shlex.quote(file)} && "
+                   f"{shlex.quote(func)} ${{__bcli_args[@]+\"${{__bcli_args[@]}}\"}} && wait")
+        return ["bash", "-c", command, "bash", *map(str, args)]
+
     def bash_popen(self, file, func, *args):
-        # Execute the function from the file
-        command = f"set -e; source {file} && {func} {' '.join(map(str, args))} && wait"
-        return subprocess.Popen(["bash", "-c", command], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        import subprocess
+        return subprocess.Popen(self._bash_argv(file, func, *args),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
 
     def resolve_includes(self, main_file, file_path, seen_files=None):
         if seen_files is None:
             seen_files = set()
+        # Depth first without recursion, an include is followed by its own
+        # includes, one generator per file being read
+        includes = []
+        pending = [self._file_includes(main_file, file_path)]
+        while pending:
+            include = next(pending[-1], None)
+            if include is None:
+                pending.pop()
+            elif include['full_path'] not in seen_files:
+                seen_files.add(include['full_path'])
+                includes.append(include)
+                pending.append(self._file_includes(main_file, include['full_path']))
+        return includes
+
+    def _file_includes(self, main_file, file_path):
+        import mmap
         #print(f"Resolving includes in {file_path}")
         try:
-            with open(file_path, 'r') as f:
-                content = f.read()
+            with open(file_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return
+                # Map the file rather than reading and decoding all of it,
+                # only the matched include lines are decoded
+                content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         except FileNotFoundError:
             print(f"Error: resolve_includes File {file_path} not found", file=sys.stderr)
-            return []
+            return
 
-        include_re = re.compile(r"^\s*(?:\.|source)\s+([^\s;]+)", re.MULTILINE)
-        includes = []
-        for match in include_re.finditer(content):
-            include_line = match.group(0).strip().split(';')[0]  # Capture only the include statement
-            include_path = match.group(1)
-            full_path = os.path.abspath(os.path.join(os.path.dirname(main_file), include_path))
-            # Ignore external files and only process internal includes that are forward from the file being run
-            if not os.path.exists(full_path) or not full_path.startswith(os.path.dirname(main_file)):
-                continue
-            if full_path not in seen_files:
-                seen_files.add(full_path)
-                includes.append({
-                    'line_number': content[:match.start()].count('\n') + 1,
+        with content:
+            # Matches come in order, count the newlines from the previous one only
+            line_number, line_start = 1, 0
+            for match in _INCLUDE_RE.finditer(content):
+                include_line = match.group(0).strip().split(b';')[0].decode()  # Capture only the include statement
+                include_path = match.group(1).decode()
+                full_path = os.path.abspath(os.path.join(os.path.dirname(main_file), include_path))
+                # Ignore external files and only process internal includes that are forward from the file being run
+                if not os.path.exists(full_path) or not full_path.startswith(os.path.dirname(main_file)):
+                    continue
+                line_number += content[line_start:match.start()].count(b'\n')
+                line_start = match.start()
+                yield {
+                    'line_number': line_number,
                     'include_line': include_line,
                     'include_path': include_path,
                     'full_path': full_path,
                     'included_from': file_path
-                })
-                # Recursively resolve includes in the included file
-                includes.extend(self.resolve_includes(main_file, full_path, seen_files))
-        return includes
+                }
+
+    def _ssh_master(self, remote):
+        import hashlib
+        import socket
+        import subprocess
+        # One persistent SSH connection per remote, shared by every bcli run:
+        # the first exec pays for the handshake, ControlPersist closes it
+        # once it has been idle for a while
+        ssh_control_path = self._ssh_masters.get(remote)
+        if ssh_control_path:
+            return ssh_control_path
+        control_dir = os.path.join(self.home_dir, "ssh-sockets")
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+        # Hashed, unix socket paths are limited to ~104 bytes
+        ssh_control_path = os.path.join(control_dir, "cm-" + hashlib.sha1(remote.encode()).hexdigest()[:12])
+        # Knock on the master's socket ourselves rather than forking an
+        # "ssh -O check", a socket left behind by a dead master is removed
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(ssh_control_path)
+            master_alive = True
+        except OSError:
+            master_alive = False
+            try:
+                os.unlink(ssh_control_path)
+            except FileNotFoundError:
+                pass
+        if not master_alive:
+            # A detached master, not ControlMaster=auto on the exec session:
+            # a master forked off that one could hold on to our stderr pipe
+            ssh_command = [
+                "ssh", "-fN", "-o", "ControlMaster=auto", "-o", f"ControlPath={ssh_control_path}",
+                "-o", "ControlPersist=600", remote
+            ]
+            subprocess.run(ssh_command, check=True)
+        self._ssh_masters[remote] = ssh_control_path
+        return ssh_control_path
 
     def ssh_popen(self, remote, file, func, *args):
-        # Open a persistent SSH connection using ControlMaster
+        import subprocess
         fname = os.path.splitext(os.path.basename(file))[0]
-        parent_pid = os.getppid()
-        ssh_control_path = tempfile.mktemp(prefix=f"bclissh-{parent_pid}-")
-        ssh_command = [
-            "ssh", "-MNf", "-o", f"ControlPath={ssh_control_path}", "-o", "ControlMaster=yes", remote
-        ]
-       # print(f"Opening persistent SSH connection to {remote}: {ssh_control_path}...")
-        subprocess.run(ssh_command, check=True)
+        ssh_control_path = self._ssh_master(remote)
 
-        # Create a temporary directory on the remote machine
+        # Ship the bash file and its includes as a single tarball, tar
+        # recreates the directory layout on the other side
         remote_temp_dir = f"/tmp/{fname}_{func}_{remote.replace('@', '_')}"
-        ssh_mkdir_command = [
-            "ssh", "-o", f"ControlPath={ssh_control_path}", remote, f"mkdir -p {remote_temp_dir}"
-        ]
-        #print(f"Creating temporary directory {remote_temp_dir} on {remote}...")
-        subprocess.run(ssh_mkdir_command, check=True)
-
-        # Send the bash file and its includes using SCP via the persistent connection
-        remote_file = os.path.join(remote_temp_dir, os.path.basename(file))
-        scp_command = [
-            "scp", "-o", f"ControlPath={ssh_control_path}", file, f"{remote}:{remote_file}"
-        ]
-        #print(f"Transferring {file} to {remote}:{remote_file}...")
-
-        result = subprocess.run(scp_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        base_dir = os.path.dirname(file)
+        paths = [os.path.basename(file)]
+        paths += [os.path.relpath(include['full_path'], base_dir) for include in self.resolve_includes(file, file)]
+        archive = subprocess.run(["tar", "-czf", "-", "-C", base_dir, "--", *paths],
+                                 stdout=subprocess.PIPE, check=True).stdout
+        # The archive goes over the session's stdin, never in a command line
+        # where other users could read it from ps / /proc/<pid>/cmdline
+        untar_command = ["ssh", "-o", f"ControlPath={ssh_control_path}", remote,
+                         f"mkdir -p {shlex.quote(remote_temp_dir)} && tar -xzf - -C {shlex.quote(remote_temp_dir)}"]
+        result = subprocess.run(untar_command, input=archive, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if result.returncode != 0:
-            print(f"Error transferring {file} to {remote}:{remote_file}")
-            print(result.stderr)
-            return result.returncode
-
-        # Scan the file for includes and transfer them as well
-        #print(f"Resolving includes for {file}...")
-        includes = self.resolve_includes(file, file)
-        #print(f"Resolved  includes for {file}...")
-        for include in includes:
-            include_file = include['full_path']
-            include_path = include['include_path']
-            relative_include_dir = os.path.dirname(include_path)
-            remote_include_dir = os.path.join(remote_temp_dir, relative_include_dir)
-            remote_include_file = os.path.join(remote_include_dir, os.path.basename(include_file))
-            # Create the directory structure on the remote machine
-            ssh_mkdir_command = [
-                "ssh", "-o", f"ControlPath={ssh_control_path}", remote, f"mkdir -p {remote_include_dir}"
-            ]
-            #print(f"Creating directory {remote_include_dir} on {remote}...")
-            subprocess.run(ssh_mkdir_command, check=True)
-            # Transfer the include file
-            scp_command = [
-                "scp", "-o", f"ControlPath={ssh_control_path}", include_file, f"{remote}:{remote_include_file}"
-            ]
-            #print(f"Transferring {include_file} to {remote}:{remote_include_file}...")
-            result = subprocess.run(scp_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            if result.returncode != 0:
-                print(f"Error transferring {file} to {remote}:{remote_file}")
-                print(result.stderr)
-                return result.returncode
+            print(f"Error transferring {file} to {remote}:{remote_temp_dir}")
+            print(result.stderr.decode(errors="replace"))
+            raise subprocess.CalledProcessError(result.returncode, untar_command)
 
         # Execute the function via the persistent SSH connection
-        remote_command = f"bash -c 'set -e; cd {remote_temp_dir} && source {os.path.basename(file)} && {func} {' '.join(map(str, args))}' && wait"
+        remote_command = shlex.join(self._bash_argv(os.path.basename(file), func, *args, cd=remote_temp_dir))
         exec_command = [
             "ssh", "-o", f"ControlPath={ssh_control_path}", remote, remote_command
         ]
         #print(f"Executing command: {remote_command}")
-        process = subprocess.Popen(exec_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        process.ssh_control_path__ = ssh_control_path
+        process = subprocess.Popen(exec_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
         return process
 
-    def handle_exec(self, remote, namespace, fname, func, *args):
+    def handle_exec(self, remote, namespace, fname, func, *args, replace_process=False):
+        import fcntl
+        import selectors
+        import subprocess
+        import traceback
         namespace = namespace or "default"
 
-        metadata = self.load_all_metadata()
-        if namespace not in metadata or fname not in metadata[namespace]:
-            raise FileNotFoundError(f"File '{fname}' not found in namespace '{namespace}'")
-
-        file = metadata[namespace][fname]
+        file = self.resolve_file(namespace, fname)
         if args and len(args) and args[0] == '--help':
             file_metadata = self.scan_bash_file(file)
             for function in file_metadata['functions']:
@@ -219,6 +435,16 @@ class Pybcli:
                             print(f"options: {opts_annotation}")
                         return 0
 
+        if replace_process and not remote:
+            # Nothing to do with the output locally, let bash take over this
+            # process and write to the terminal itself, its exit status
+            # becomes ours. atexit handlers don't run past exec, save a
+            # pending scan (e.g. from --help above) now
+            self._dump_scan_cache()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execvp("bash", self._bash_argv(file, func, *args))
+
         process = None
         # TODO: handle return code properly
         rc = 127
@@ -227,30 +453,35 @@ class Pybcli:
                 process = self.ssh_popen(remote, file, func, *args)
             else:
                 process = self.bash_popen(file, func, *args)
-            # Stream the output and errors while the command is running
-            while True:
-                reads = [process.stdout.fileno(), process.stderr.fileno()]
-                ret = select.select(reads, [], [])
-                for fd in ret[0]:
-                    if fd == process.stdout.fileno():
-                        output = process.stdout.readline()
-                        if output:
-                            print(output, end="")
-                    if fd == process.stderr.fileno():
-                        error = process.stderr.readline()
-                        if error:
-                            print(error, end="")
-                if process.poll() is not None:
-                    break
-
-            # Print any remaining errors
-            stdout = process.stdout.read()
-            if stdout:
-                print(stdout)
-            stderr = process.stderr.read()
-            if stderr:
-                print(stderr)
-            rc = process.poll()
+            # Grow the pipes (64K by default on Linux) so a chatty function
+            # doesn't stall on a full pipe every time we're a bit late reading
+            if hasattr(fcntl, "F_SETPIPE_SZ"):
+                for pipe in (process.stdout, process.stderr):
+                    try:
+                        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, 1 << 20)
+                    except OSError:
+                        # over /proc/sys/fs/pipe-max-size or the user's pipe quota
+                        pass
+            # Stream the output and errors while the command is running,
+            # forward raw chunks as they come, no per line decoding
+            sys.stdout.flush()
+            sys.stderr.flush()
+            sel = selectors.DefaultSelector()
+            sel.register(process.stdout, selectors.EVENT_READ, sys.stdout.buffer)
+            sel.register(process.stderr, selectors.EVENT_READ, sys.stderr.buffer)
+            while sel.get_map():
+                for key, _ in sel.select():
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        sel.unregister(key.fileobj)
+                        continue
+                    key.data.write(chunk)
+                # Flush once per wakeup rather than per chunk, but don't wait
+                # for a newline either, prompts must show up right away
+                sys.stdout.buffer.flush()
+                sys.stderr.buffer.flush()
+            sel.close()
+            rc = process.wait()
             #print(f"Command execution complete with return code: {rc}")
         except subprocess.CalledProcessError as e:
             print(f"Command error: {e}")
@@ -263,68 +494,40 @@ class Pybcli:
             print("Execution interrupted")
             rc = 130
             if not process:
-                pass
+                return rc
             process.kill()
-            process.wait()
+            # Whatever bash spawned may still hold the pipes open, only drain
+            # what is already there instead of waiting for EOF
+            try:
+                stdout, stderr = process.communicate(timeout=0.5)
+            except subprocess.TimeoutExpired:
+                stdout, stderr = b'', b''
+                process.wait()
             print(f"Command execution complete with return code: {process.returncode}")
-            stdout = process.stdout.read()
             if stdout:
-                print("--- STDOUT END ---")
-                print(stdout)
-            stderr = process.stderr.read()
+                print("--- STDOUT END ---", flush=True)
+                sys.stdout.buffer.write(stdout)
+                sys.stdout.buffer.flush()
             if stderr:
-                print("--- STDERR END ---")
-                print(stderr)
+                print("--- STDERR END ---", flush=True)
+                sys.stderr.buffer.write(stderr)
+                sys.stderr.buffer.flush()
             rc = process.returncode if process.returncode else 130
         finally:
             if process:
                 process.stdout.close()
                 process.stderr.close()
-            if process and hasattr(process, 'ssh_control_path__'):
-                # Close the persistent SSH connection
-                close_command = ["ssh", "-O", "exit", "-o", f"ControlPath={process.ssh_control_path__}", remote]
-                #print("Closing persistent SSH connection...")
-                subprocess.run(close_command, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return rc
+        # Killed by a signal, report it the way a shell would (128 + signal)
+        return 128 - rc if rc < 0 else rc
 
     def scan_bash_file(self, file_path):
         # Scan a bash file and extract metadata
-        if not os.path.exists(file_path):
+        try:
+            global_annotations, functions = self._scan_cached(file_path)
+        except FileNotFoundError:
             print(f"{file_path} doesn't exist. Please run bcli purge", file=sys.stderr)
             return {}
 
-        with open(file_path, 'r') as f:
-            content = f.read()
-
-        # Patterns for global and function-specific annotations
-        global_annotation_re = re.compile(r"#bcli:\s+(\w+)\s+(.*)")
-        function_re = re.compile(r"(?m)^\s*(\w+)\s*\(\s*\)\s*\{")
-        func_annotation_re = re.compile(r"#bcli:func\s+(\w+)\s+(.*)")
-
-        # Extract global annotations
-        global_annotations = {}
-        for match in global_annotation_re.finditer(content):
-            global_annotations[match.group(1)] = match.group(2)
-
-        # Extract function metadata
-        functions = []
-        for match in function_re.finditer(content):
-            name = match.group(1)
-            annotations = {}
-
-            # Find function-specific annotations immediately preceding the function definition
-            func_start_index = match.start()
-            preceding_lines = content[:func_start_index].splitlines()
-            preceding_lines.reverse()
-            for line in preceding_lines:
-                annotation_match = func_annotation_re.match(line)
-                if annotation_match:
-                    annotations[annotation_match.group(1)] = annotation_match.group(2)
-                elif line.strip() != "" and not line.strip().startswith('#'):
-                    # Stop if we hit a non-annotation or non-comment line
-                    break
-            functions.append({'name': name, 'annotations': annotations})
-
         # Extract includes
         includes = self.resolve_includes(file_path, file_path)
 
@@ -337,10 +540,129 @@ class Pybcli:
 
         return file_metadata
 
+    def _scan_cached(self, file_path):
+        # Raises FileNotFoundError, no separate exists() check
+        key = _metadata_key(os.stat(file_path))
+        self._load_scan_cache()
+        cached = _SCAN_CACHE.get(file_path)
+        if cached is None or cached[0] != key:
+            cached = (key, self._scan_annotations(file_path))
+            _SCAN_CACHE[file_path] = cached
+        if self._scan_cache_keys.get(file_path) != key:
+            self._scan_cache_keys[file_path] = key
+            self._scan_cache_dirty = True
+        return cached[1]
+
+    def _load_scan_cache(self):
+        # Scan results are kept in the home dir across runs, only files that
+        # changed since are scanned again
+        if self._scan_cache_keys is not None:
+            return
+        self._scan_cache_keys = {}
+        try:
+            with open(self.scan_cache_file, 'rb') as cf:
+                for path, (key, global_annotations, functions) in json.load(cf).items():
+                    self._scan_cache_keys[path] = tuple(key)
+                    _SCAN_CACHE.setdefault(path, (tuple(key), (global_annotations, functions)))
+        except (OSError, ValueError):
+            pass
+        atexit.register(self._dump_scan_cache)
+
+    def _dump_scan_cache(self):
+        if not self._scan_cache_dirty:
+            return
+        # Only this home's entries (_SCAN_CACHE is shared by every instance),
+        # and drop scripts that were deleted or renamed since
+        scan_cache = {}
+        for path in self._scan_cache_keys:
+            cached = _SCAN_CACHE.get(path)
+            try:
+                key = _metadata_key(os.stat(path))
+            except OSError:
+                continue
+            if cached and cached[0] == key:
+                scan_cache[path] = [key, *cached[1]]
+        tmp_file = f"{self.scan_cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'w') as cf:
+                cf.write(json.dumps(scan_cache))
+            os.replace(tmp_file, self.scan_cache_file)
+            self._scan_cache_dirty = False
+        except OSError:
+            # it's only a cache
+            pass
+
+    def _scan_annotations(self, file_path):
+        # Single pass over the file: function-specific annotations pile up until
+        # the next function definition, any other non-comment line drops them
+        global_annotations = {}
+        functions = []
+        annotations = {}
+        header = None  # "name()" seen, its "{" is expected on a following line
+        with open(file_path, 'r') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                stripped = line.strip()
+                if header:
+                    if not stripped:
+                        continue
+                    if stripped.startswith('{'):
+                        functions.append({'name': header, 'annotations': annotations})
+                        annotations = {}
+                        header = None
+                        continue
+                    # not a function definition after all
+                    header = None
+                    annotations = {}
+
+                # Most lines are plain code, only hand the lines holding the
+                # literal parts of a pattern to the regex engine
+                if '#bcli:' in line:
+                    match = _GLOBAL_ANNOTATION_RE.search(line)
+                    if match:
+                        global_annotations[match.group(1)] = match.group(2)
+
+                if '(' in line:
+                    match = _FUNCTION_RE.match(line)
+                    if match:
+                        functions.append({'name': match.group(1), 'annotations': annotations})
+                        annotations = {}
+                        continue
+                    match = _FUNCTION_HEADER_RE.match(line)
+                    if match:
+                        header = match.group(1)
+                        continue
+
+                match = _FUNC_ANNOTATION_RE.match(line) if line.startswith('#bcli:func') else None
+                if match:
+                    # the topmost annotation wins
+                    annotations.setdefault(match.group(1), match.group(2))
+                elif stripped != "" and not stripped.startswith('#'):
+                    annotations = {}
+
+        return global_annotations, functions
+
+    def _scan_files(self, paths):
+        # Files are scanned independently, overlap the reads in threads unless
+        # there are too few to bother. Threads rather than processes so the
+        # scans land in the (persistent) scan cache, which is loaded up front.
+        if len(paths) < 4:
+            return {path: self.scan_bash_file(path) for path in paths}
+        from concurrent.futures import ThreadPoolExecutor
+        self._load_scan_cache()
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            return dict(zip(paths, executor.map(self.scan_bash_file, paths)))
+
     def handle_info(self, verbosity=1, namespace=None, fname=None, func=None):
         # Print the contents of the config YAML files for both home and sys
-        for name in ['home', 'sys']:
-            metadata = self.load_metadata(is_sys=(name == 'sys'))
+        configs = [(name, self.load_metadata(is_sys=(name == 'sys'))) for name in ['home', 'sys']]
+        scans = {}
+        if verbosity >= 1:
+            paths = {file_path for _, metadata in configs
+                     for ns, files in metadata.items() if not namespace or ns == namespace
+                     for file_name, file_path in files.items() if not fname or file_name == fname}
+            scans = self._scan_files(sorted(paths))
+        for name, metadata in configs:
             print(f"--- {name.upper()} CONFIG ---")
             for ns, files in metadata.items():
                     if namespace and ns != namespace:
@@ -351,7 +673,7 @@ class Pybcli:
                             continue
                         print(f"  {file_name}: {file_path}")
                         if verbosity >= 1:
-                            file_metadata = self.scan_bash_file(file_path)
+                            file_metadata = scans[file_path]
                             if not file_metadata:
                                 continue
                             if verbosity == 2:
@@ -365,9 +687,10 @@ class Pybcli:
                                 print(json.dumps(file_metadata, indent=4))
 
     def handle_purge(self):
-        # Load metadata for both home and sys
-        home_metadata = self.load_metadata(is_sys=False)
-        sys_metadata = self.load_metadata(is_sys=True)
+        # Load metadata for both home and sys, purge_metadata() builds new
+        # dicts so the cached ones can be used as is
+        home_metadata = self._get_metadata(self.home_metadata_file, copy=False)
+        sys_metadata = self._get_metadata(self.sys_metadata_file, copy=False)
 
         # Function to purge non-existing files from metadata
         def purge_metadata(metadata):
@@ -378,24 +701,24 @@ class Pybcli:
                     purged_metadata[namespace] = purged_files
             return purged_metadata
 
-        # Purge home metadata
+        # Purge home metadata, only rewrite the files that lost entries
         if home_metadata:
             purged_home_metadata = purge_metadata(home_metadata)
-            with open(self.home_metadata_file, 'w') as mf:
-                yaml.safe_dump(purged_home_metadata, mf)
-                mf.close()
+            if purged_home_metadata != home_metadata:
+                self._dump_metadata(self.home_metadata_file, purged_home_metadata)
             print(f"Purged home metadata at '{self.home_metadata_file}'")
 
         # Purge sys metadata
         if sys_metadata:
             purged_sys_metadata = purge_metadata(sys_metadata)
+            if purged_sys_metadata == sys_metadata:
+                print(f"Purged sys metadata at '{self.sys_metadata_file}'")
+                return
             # check permissions
             if os.geteuid() != 0:
                 print("You need to be root to purge sys metadata")
                 return
-            with open(self.sys_metadata_file, 'w') as mf:
-                yaml.safe_dump(purged_sys_metadata, mf)
-                mf.close()
+            self._dump_metadata(self.sys_metadata_file, purged_sys_metadata)
             print(f"Purged sys metadata at '{self.sys_metadata_file}'")
 
     def handle_remove(self, namespace, fname=None):
@@ -419,9 +742,7 @@ class Pybcli:
         # Remove from home metadata
         home_updated = remove_from_metadata(home_metadata)
         if home_updated:
-            with open(self.home_metadata_file, 'w') as mf:
-                yaml.safe_dump(home_metadata, mf)
-                mf.close()
+            self._dump_metadata(self.home_metadata_file, home_metadata)
             print(f"Updated home metadata at '{self.home_metadata_file}'")
 
         # Remove from sys metadata
@@ -431,9 +752,7 @@ class Pybcli:
             if os.geteuid() != 0:
                 print("You need to be root to modify sys metadata")
                 return
-            with open(self.sys_metadata_file, 'w') as mf:
-                yaml.safe_dump(sys_metadata, mf)
-                mf.close()
+            self._dump_metadata(self.sys_metadata_file, sys_metadata)
             print(f"Updated sys metadata at '{self.sys_metadata_file}'")
 
         if not home_updated and not sys_updated:
@@ -445,6 +764,7 @@ def arg_complete(comp_cword, prev, curr, comp_words):
         return [f for f in options if f.startswith(curr)]
     #comp_words = comp_words.split()
     cmd = comp_words[1] or ''
+    pybcli = Pybcli()
     # Custom argument completion logic
     if cmd == 'import':
         # Provide completion for import command
@@ -453,18 +773,10 @@ def arg_complete(comp_cword, prev, curr, comp_words):
             return []
         if prev == "import": # handled in the dump_completion_script function
                 return []
-        pybcli = Pybcli()
-        home_metadata = pybcli.load_metadata(is_sys=False)
-        home_namespaces = list(home_metadata.keys())
-        options = [f"home.{ns}" for ns in home_namespaces]
-
-        sys_metadata = pybcli.load_metadata(is_sys=True)
-        sys_namespaces = list(sys_metadata.keys())
-
-        # add sys. prefix to sys namespaces
-        options += [f"sys.{ns}" for ns in sys_namespaces]
-        for ns in home_namespaces + sys_namespaces:
-                return [f for f in options if f.startswith(curr)]
+        # add home. and sys. prefixes to the namespaces
+        options = [f"home.{ns}" for ns in pybcli.load_metadata(is_sys=False)]
+        options += [f"sys.{ns}" for ns in pybcli.load_metadata(is_sys=True)]
+        return [f for f in options if f.startswith(curr)]
     elif cmd == 'exec' or cmd == 'remove' or cmd == 'info':
         # remove --ssh server from comp_words
         # find the index of --ssh
@@ -476,42 +788,29 @@ def arg_complete(comp_cword, prev, curr, comp_words):
                 comp_words.pop(ssh_index)  # Remove the word after '--ssh'
                 comp_cword -= 1
 
+        metadata = pybcli._metadata_view()
         # Provide completion for exec command
         if comp_cword == 2:
             # Provide completion for namespaces
-            pybcli = Pybcli()
-            metadata = pybcli.load_all_metadata()
-            namespaces = list(metadata.keys())
-            return [f for f in namespaces if f.startswith(curr)]
+            return [f for f in metadata if f.startswith(curr)]
         elif comp_cword == 3:
             # Provide completion for files
-            pybcli = Pybcli()
-            namespace = comp_words[2]
-            metadata = pybcli.load_all_metadata()
-            if namespace in metadata:
-                files = list(metadata[namespace].keys())
+            files = metadata.get(comp_words[2])
+            if files:
                 return [f for f in files if f.startswith(curr)]
         elif comp_cword == 4:
             # Provide completion for functions
-            pybcli = Pybcli()
-            namespace = comp_words[2]
-            file = comp_words[3]
-            metadata = pybcli.load_all_metadata()
-            if namespace in metadata and file in metadata[namespace]:
-                file_path = metadata[namespace][file]
+            file_path = metadata.get(comp_words[2], {}).get(comp_words[3])
+            if file_path:
                 file_metadata = pybcli.scan_bash_file(file_path)
                 if file_metadata:
                     functions = [f['name'] for f in file_metadata['functions']]
                     return [f for f in functions if f.startswith(curr)]
         elif comp_cword > 4:
             # Provide completion for function arguments and options
-            pybcli = Pybcli()
-            namespace = comp_words[2]
-            file = comp_words[3]
             func = comp_words[4]
-            metadata = pybcli.load_all_metadata()
-            if namespace in metadata and file in metadata[namespace]:
-                file_path = metadata[namespace][file]
+            file_path = metadata.get(comp_words[2], {}).get(comp_words[3])
+            if file_path:
                 file_metadata = pybcli.scan_bash_file(file_path)
                 if file_metadata:
                     for function in file_metadata['functions']:
@@ -534,7 +833,11 @@ def install_bash_completion(system_wide=True):
     _pybcli_completion() {
         local cur prev words cword
         _get_comp_words_by_ref -n : cur prev words cword
-        # return files if import
+        [[ $cword -eq 1 ]] && {
+            COMPREPLY=($(compgen -W "import remove exec info purge install-bash-completion" -- "$cur"))
+            return
+        }
+        # return nothing if import, complete -o default falls back to file names
         [[ $cword -eq 2 ]] && [ "$prev" == "import" ] && {
             COMPREPLY=($(compgen -- "$cur"))
             return
@@ -545,9 +848,59 @@ def install_bash_completion(system_wide=True):
             COMPREPLY=($(compgen -A hostname -- "$cur"))
             return
         }
+        _pybcli_index_completion && return
         #echo bcli complete "$cword" \\"$prev\\" \\"$cur\\" \\"${words[@]}\\"
         COMPREPLY+=($(bcli complete \"$cword\" \"$prev\" \"$cur\" "${words[@]}"))
     }
+    # Complete namespaces, files and functions from the completion.idx files
+    # bcli writes next to its metadata, without starting python.
+    # Fails if an index is missing or out of date, bcli complete is used then.
+    _pybcli_index_completion() {
+        local w=("${words[@]}") c=$cword dir idx ns f path funcs prefix cand
+        local cands=() uniq=()
+        local -A seen=()
+        case "${w[1]}" in
+            import) [[ $c -eq 3 ]] || return 1 ;;
+            exec|remove|info) ;;
+            *) return 1 ;;
+        esac
+        if [ "${w[2]}" == "--ssh" ]; then
+            w=("${w[@]:0:2}" "${w[@]:4}")
+            c=$((c - 2))
+        fi
+        [[ $c -ge 2 && $c -le 4 ]] || return 1
+        for dir in ~/.pybcli /etc/pybcli; do
+            [ -e "$dir/metadata.yaml" ] || continue
+            idx="$dir/completion.idx"
+            [[ -r "$idx" && ! "$dir/metadata.yaml" -nt "$idx" ]] || return 1
+            # import takes home.<namespace> or sys.<namespace>
+            prefix=""
+            if [ "${w[1]}" == "import" ]; then
+                prefix="home."
+                [ "$dir" == "/etc/pybcli" ] && prefix="sys."
+            fi
+            while IFS=$'\\t' read -r ns f path funcs; do
+                if [[ $c -eq 2 || -n "$prefix" ]]; then
+                    cands+=("$prefix$ns")
+                elif [ "$ns" == "${w[2]}" ]; then
+                    if [[ $c -eq 3 ]]; then
+                        cands+=("$f")
+                    elif [ "$f" == "${w[3]}" ]; then
+                        # the script changed since the index was written
+                        [ "$path" -nt "$idx" ] && return 1
+                        cands+=($funcs)
+                    fi
+                fi
+            done < "$idx"
+        done
+        # a namespace has a line per file, and may be in both home and sys
+        for cand in "${cands[@]}"; do
+            [[ -z "$cand" || -n "${seen[$cand]}" ]] && continue
+            seen[$cand]=1
+            uniq+=("$cand")
+        done
+        COMPREPLY+=($(compgen -W "${uniq[*]}" -- "$cur"))
+    }
     complete -o default -F _pybcli_completion bcli pybcli ./pybcli.py pybcli.py
     """
     if system_wide:
@@ -561,10 +914,20 @@ def install_bash_completion(system_wide=True):
     print(f"Writing bash completion script to {completion_file}...")
     with open(completion_file, 'w') as f:
         f.write(bash_completion_script)
-        f.close()
     print(f"Bash completion script installed to {completion_file}")
 
+def _fast_complete(argv):
+    # Bash completion runs "bcli complete cword prev curr words..." on every
+    # TAB press, answer it without building the whole argparse tree
+    completions = arg_complete(int(argv[0]), argv[1], argv[2], argv[3:])
+    for completion in completions:
+        print(completion)
+
 def main():
+    if len(sys.argv) >= 5 and sys.argv[1] == 'complete' and sys.argv[2].isdigit():
+        return _fast_complete(sys.argv[2:])
+
+    import argparse
     pybcli = Pybcli()
     parser = argparse.ArgumentParser(prog='pybcli')
     subparsers = parser.add_subparsers(dest='command')
@@ -608,8 +971,11 @@ def main():
     # Install completion script subcommand
     subparsers.add_parser('install-bash-completion', help='Install bash completion script')
 
-    # Enable bash completion
-    argcomplete.autocomplete(parser)
+    # Enable argcomplete bash completion, it only does anything when invoked
+    # by its completion hook so don't even import it otherwise
+    if "_ARGCOMPLETE" in os.environ:
+        import argcomplete
+        argcomplete.autocomplete(parser)
 
     args = parser.parse_args()
 
@@ -621,7 +987,8 @@ def main():
         print(f"location: {location}, namespace: {args.namespace}")
         pybcli.handle_import(args.path, location, args.namespace)
     elif args.command == 'exec':
-        pybcli.handle_exec(args.ssh, args.namespace, args.file, args.func, *args.args)
+        sys.exit(pybcli.handle_exec(args.ssh, args.namespace, args.file, args.func, *args.args,
+                                    replace_process=True))
     elif args.command == 'info':
         pybcli.handle_info(args.verbose, args.namespace, args.file, args.func)
     elif args.command == 'purge':
@@ -629,9 +996,7 @@ def main():
     elif args.command == 'remove':
         pybcli.handle_remove(args.namespace, args.file)
     elif args.command == 'complete':
-        completions = arg_complete(args.comp_cword, args.prev, args.curr, args.comp_words)
-        for completion in completions:
-            print(completion)
+        _fast_complete([args.comp_cword, args.prev, args.curr] + args.comp_words)
     elif args.command == 'install-bash-completion':
         system_wide = os.geteuid() == 0  # Check if running as root
         install_bash_completion(system_wide)
@@ -2,18 +2,25 @@
 import unittest
 import os
 import shutil
+import subprocess
 import yaml
 import tempfile
+import contextlib
+import io
+import json
 import tracemalloc
-from pybcli.pybcli import Pybcli
+from pybcli.pybcli import Pybcli, install_bash_completion
+
+# Keep the test config dirs in memory where possible, every import fsyncs metadata
+_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
 
 class TestPybcli(unittest.TestCase):
     BASH_SCRIPTS_DIR = os.path.abspath("samples")
-    @classmethod
+
     def setUp(self):
         # Create temporary directories for testing
-        self.temp_home_dir = tempfile.mkdtemp()
-        self.temp_sys_dir = tempfile.mkdtemp()
+        self.temp_home_dir = tempfile.mkdtemp(dir=_TMP_DIR)
+        self.temp_sys_dir = tempfile.mkdtemp(dir=_TMP_DIR)
 
         # Initialize Pybcli instance and configure it to use the temporary directories
         self.pybcli = Pybcli(self.temp_home_dir, self.temp_sys_dir)
@@ -23,6 +30,11 @@ class TestPybcli(unittest.TestCase):
         shutil.rmtree(self.temp_home_dir)
         shutil.rmtree(self.temp_sys_dir)
 
+    def _load_metadata_file(self, path):
+        # bcli writes metadata as JSON, YAML files are only read for migration
+        with open(path, "rb") as f:
+            return json.load(f)
+
     def _test_import_namespace(self, bash_file, is_sys, namespace):
         # Test importing a file into the home location with default namespace
         test_file = f"{self.BASH_SCRIPTS_DIR}/{bash_file}"
@@ -35,15 +47,12 @@ class TestPybcli(unittest.TestCase):
             conf_dir = self.pybcli.sys_dir if is_sys else self.pybcli.home_dir
             # Check metadata
             metadata_file = os.path.join(conf_dir, "metadata.yaml")
-            with open(metadata_file, "r") as mf:
-                metadata = yaml.safe_load(mf)
-                self.assertIsInstance(metadata, dict)
-                self.assertIn(namespace, metadata)
-                fname = os.path.splitext(os.path.basename(test_file))[0]
-                self.assertIn(fname, metadata[namespace])
-                self.assertEqual(metadata[namespace][fname], os.path.abspath(test_file))
-                # close the file
-                mf.close()
+            metadata = self._load_metadata_file(metadata_file)
+            self.assertIsInstance(metadata, dict)
+            self.assertIn(namespace, metadata)
+            fname = os.path.splitext(os.path.basename(test_file))[0]
+            self.assertIn(fname, metadata[namespace])
+            self.assertEqual(metadata[namespace][fname], test_file)
         finally:
             pass
 
@@ -58,20 +67,17 @@ class TestPybcli(unittest.TestCase):
             conf_dir = self.pybcli.sys_dir if is_sys else self.pybcli.home_dir
             # Check metadata
             metadata_file = os.path.join(conf_dir, "metadata.yaml")
-            with open(metadata_file, "r") as mf:
-                metadata = yaml.safe_load(mf)
-                self.assertIsInstance(metadata, dict)
-                self.assertIn(namespace, metadata)
-                for root, dirs, files in os.walk(dir):
-                    for file in files:
-                        # check if file is a bash file?
-                        if not file.endswith(".sh"):
-                            continue
-                        fname = os.path.splitext(file)[0]
-                        self.assertIn(fname, metadata[namespace])
-                        self.assertEqual(metadata[namespace][fname], os.path.abspath(f"{root}/{file}"))
-                # close the file
-                mf.close()
+            metadata = self._load_metadata_file(metadata_file)
+            self.assertIsInstance(metadata, dict)
+            self.assertIn(namespace, metadata)
+            for root, dirs, files in os.walk(dir):
+                for file in files:
+                    # check if file is a bash file?
+                    if not file.endswith(".sh"):
+                        continue
+                    fname = os.path.splitext(file)[0]
+                    self.assertIn(fname, metadata[namespace])
+                    self.assertEqual(metadata[namespace][fname], os.path.abspath(f"{root}/{file}"))
         finally:
             pass
 
@@ -89,6 +95,94 @@ class TestPybcli(unittest.TestCase):
     def test_import_sys_custom_namespace(self):
         self._test_import_namespace("simple.sh", True, "custom_namespace")
 
+    def test_import_completion_index(self):
+        test_file = f"{self.BASH_SCRIPTS_DIR}/simple.sh"
+        self.pybcli.handle_import(test_file, "home", "test_namespace")
+        index_file = os.path.join(self.pybcli.home_dir, "completion.idx")
+        with open(index_file, "r") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        ns, fname, path, funcs = lines[0].split("\t")
+        self.assertEqual(ns, "test_namespace")
+        self.assertEqual(fname, "simple")
+        self.assertEqual(path, test_file)
+        self.assertEqual(funcs.split(), ["function1", "function2", "main", "forward_args", "args_test"])
+
+    def test_import_unreadable_script(self):
+        test_file = os.path.join(self.temp_home_dir, "binary.sh")
+        with open(test_file, "wb") as f:
+            f.write(b"echo \xff\n")
+        self.pybcli.handle_import(test_file, "home", "test_namespace")
+        self.assertEqual(self.pybcli.load_metadata()["test_namespace"]["binary"], test_file)
+        with open(os.path.join(self.pybcli.home_dir, "completion.idx"), "r") as f:
+            self.assertEqual(f.read(), f"test_namespace\tbinary\t{test_file}\t\n")
+        self.assertFalse([f for f in os.listdir(self.pybcli.home_dir) if f.endswith(".tmp")])
+
+    def test_load_all_metadata_copy(self):
+        test_file = f"{self.BASH_SCRIPTS_DIR}/simple.sh"
+        self.pybcli.handle_import(test_file, "home", "test_namespace")
+        self.pybcli.handle_import(f"{self.BASH_SCRIPTS_DIR}/moderate.sh", "sys", "test_namespace")
+        metadata = self.pybcli.load_all_metadata()
+        self.assertEqual(set(metadata["test_namespace"]), {"simple", "moderate"})
+        metadata["test_namespace"]["simple"] = "/changed.sh"
+        self.assertEqual(self.pybcli.resolve_file("test_namespace", "simple"), test_file)
+
+    def test_load_all_metadata_home_only_copy(self):
+        test_file = f"{self.BASH_SCRIPTS_DIR}/simple.sh"
+        self.pybcli.handle_import(test_file, "home", "test_namespace")
+        metadata = self.pybcli.load_all_metadata()
+        metadata["test_namespace"]["simple"] = "/changed.sh"
+        metadata["other_namespace"] = {}
+        self.assertEqual(self.pybcli.resolve_file("test_namespace", "simple"), test_file)
+        self.assertEqual(self.pybcli.load_metadata(), {"test_namespace": {"simple": test_file}})
+
+    def _complete(self, *words):
+        # Run the installed completion with bash-completion's word splitting stubbed out
+        script = os.path.join(self.temp_home_dir, ".local/share/bash-completion/completions/pybcli")
+        command = """
+            source "$1"; shift
+            _get_comp_words_by_ref() {
+                words=("${test_words[@]}"); cword=$((${#words[@]} - 1))
+                cur=${words[cword]}; prev=${words[cword - 1]}
+            }
+            bcli() { echo "bcli-complete-called"; }
+            test_words=("$@")
+            _pybcli_completion
+            printf '%s\\n' "${COMPREPLY[@]}"
+        """
+        env = dict(os.environ, HOME=self.temp_home_dir)
+        result = subprocess.run(["bash", "-c", command, "bash", script, "bcli", *words],
+                                env=env, stdout=subprocess.PIPE, text=True, check=True)
+        return result.stdout.split()
+
+    def test_bash_completion_index(self):
+        home = os.environ.get("HOME")
+        os.environ["HOME"] = self.temp_home_dir
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                install_bash_completion(False)
+        finally:
+            os.environ["HOME"] = home
+        pybcli = Pybcli(os.path.join(self.temp_home_dir, ".pybcli"), self.temp_sys_dir)
+        pybcli.handle_import(f"{self.BASH_SCRIPTS_DIR}/simple.sh", "home", "ns")
+        pybcli.handle_import(f"{self.BASH_SCRIPTS_DIR}/moderate.sh", "home", "ns")
+        self.assertEqual(self._complete("exec", ""), ["--ssh", "ns"])
+        self.assertEqual(self._complete("exec", "ns", ""), ["simple", "moderate"])
+        self.assertEqual(self._complete("exec", "ns", "simple", "f"), ["function1", "function2", "forward_args"])
+        self.assertEqual(self._complete("exec", "--ssh", "h", "ns", ""), ["simple", "moderate"])
+        self.assertEqual(self._complete("import", "x", ""), ["home.ns"])
+
+    def test_load_yaml_metadata(self):
+        test_file = f"{self.BASH_SCRIPTS_DIR}/simple.sh"
+        metadata_file = os.path.join(self.pybcli.home_dir, "metadata.yaml")
+        with open(metadata_file, "w") as mf:
+            yaml.safe_dump({"test_namespace": {"simple": test_file}}, mf)
+        self.assertEqual(self.pybcli.load_metadata(), {"test_namespace": {"simple": test_file}})
+        self.assertTrue(os.path.exists(metadata_file + ".json"))
+        self.pybcli.handle_import(f"{self.BASH_SCRIPTS_DIR}/moderate.sh", "home", "test_namespace")
+        self.assertEqual(self.pybcli.load_metadata()["test_namespace"]["simple"], test_file)
+        self.assertFalse(os.path.exists(metadata_file + ".json"))
+
     def _test_scan_file_funcs(self, bash_file, func_list):
         test_file = f"{self.BASH_SCRIPTS_DIR}/{bash_file}"
         fmeta = self.pybcli.scan_bash_file(test_file)
@@ -104,6 +198,44 @@ class TestPybcli(unittest.TestCase):
     def test_scan_bash_file(self):
         self._test_scan_file_funcs("simple.sh", ["function1", "function2", "main"])
 
+    def test_scan_bash_file_modified(self):
+        test_file = os.path.join(self.temp_home_dir, "changing.sh")
+        with open(test_file, "w") as f:
+            f.write("function1() {\n    :\n}\n")
+        fmeta = self.pybcli.scan_bash_file(test_file)
+        self.assertEqual([meta["name"] for meta in fmeta["functions"]], ["function1"])
+        with open(test_file, "a") as f:
+            f.write("function2() {\n    :\n}\n")
+        fmeta = self.pybcli.scan_bash_file(test_file)
+        self.assertEqual([meta["name"] for meta in fmeta["functions"]], ["function1", "function2"])
+
+    def test_scan_cache_file(self):
+        test_file = f"{self.BASH_SCRIPTS_DIR}/simple.sh"
+        self.pybcli.scan_bash_file(test_file)
+        self.pybcli._dump_scan_cache()
+        with open(self.pybcli.scan_cache_file, "r") as f:
+            scan_cache = json.load(f)
+        key, global_annotations, functions = scan_cache[test_file]
+        self.assertEqual(len(key), 3)
+        self.assertEqual([meta["name"] for meta in functions], ["function1", "function2", "main", "forward_args", "args_test"])
+
+    def test_scan_cache_file_pruned(self):
+        test_file = os.path.join(self.temp_home_dir, "deleted.sh")
+        with open(test_file, "w") as f:
+            f.write("function1() {\n    :\n}\n")
+        self.pybcli.scan_bash_file(test_file)
+        self.pybcli._dump_scan_cache()
+        os.remove(test_file)
+        # another home in the same process shares the in-memory scan cache
+        other = Pybcli(self.temp_sys_dir, self.temp_sys_dir)
+        other.scan_bash_file(f"{self.BASH_SCRIPTS_DIR}/moderate.sh")
+        other._dump_scan_cache()
+        self.pybcli.scan_bash_file(f"{self.BASH_SCRIPTS_DIR}/simple.sh")
+        self.pybcli._dump_scan_cache()
+        with open(self.pybcli.scan_cache_file, "r") as f:
+            scan_cache = json.load(f)
+        self.assertEqual(list(scan_cache), [f"{self.BASH_SCRIPTS_DIR}/simple.sh"])
+
     def test_scan_bash_file_includes(self):
         test_file = f"{self.BASH_SCRIPTS_DIR}/test_includes.sh"
         fmeta = self.pybcli.scan_bash_file(test_file)
@@ -114,34 +246,44 @@ class TestPybcli(unittest.TestCase):
                 'line_number': 1,
                 'include_line': '. ./simple.sh',
                 'include_path': './simple.sh',
-                'full_path': os.path.abspath(os.path.join(self.BASH_SCRIPTS_DIR, 'simple.sh')),
-                'included_from': os.path.abspath(test_file)
+                'full_path': os.path.join(self.BASH_SCRIPTS_DIR, 'simple.sh'),
+                'included_from': test_file
             },
             {
                 'line_number': 2,
                 'include_line': 'source ./moderate.sh',
                 'include_path': './moderate.sh',
-                'full_path': os.path.abspath(os.path.join(self.BASH_SCRIPTS_DIR, 'moderate.sh')),
-                'included_from': os.path.abspath(test_file)
+                'full_path': os.path.join(self.BASH_SCRIPTS_DIR, 'moderate.sh'),
+                'included_from': test_file
             }
         ]
         self.assertEqual(fmeta["includes"], expected_includes)
 
+    def test_info_functions(self):
+        self.pybcli.handle_import("samples", "home", "mydir")
+        with tempfile.TemporaryFile(mode='w+') as temp_output:
+            with contextlib.redirect_stdout(temp_output):
+                self.pybcli.handle_info(2, "mydir")
+            temp_output.seek(0)
+            output = temp_output.read()
+        self.assertIn("Namespace: mydir", output)
+        for fname in ["simple", "moderate", "test_includes", "include1"]:
+            self.assertIn(f"  {fname}: ", output)
+        self.assertRegex(output, r"- function1 +\n")
+        self.assertRegex(output, r"- i_shall_pass +\n")
+
     def _test_exec(self, is_sys, namespace, bash_file, func_name, *args):
-        test_file = f"{self.BASH_SCRIPTS_DIR}/{bash_file}"
+        test_file = os.path.join(self.BASH_SCRIPTS_DIR, bash_file)
         fname = os.path.splitext(os.path.basename(test_file))[0]
         location = "sys" if is_sys else "home"
         rc, output = -1, None
         try:
             self.pybcli.handle_import(test_file, location, namespace)
-            with tempfile.TemporaryFile(mode='w+') as temp_output:
-                original_stdout = os.dup(1)
-                os.dup2(temp_output.fileno(), 1)
+            # handle_exec relays the child's output through sys.stdout.buffer
+            temp_output = io.TextIOWrapper(io.BytesIO())
+            with contextlib.redirect_stdout(temp_output):
                 rc = self.pybcli.handle_exec(None, namespace, fname, func_name, *args)
-                os.dup2(original_stdout, 1)
-                os.close(original_stdout)
-                temp_output.seek(0)
-                output = temp_output.read()
+            output = temp_output.buffer.getvalue().decode()
         except FileNotFoundError:
             self.fail(f"Test file {test_file} not found.")
         finally:
@@ -156,6 +298,29 @@ class TestPybcli(unittest.TestCase):
         self.assertIn("function2 here arg1 arg2", output)
         self.assertIn("Args: arg1 arg2 arg3", output)
 
+    def test_exec_args_quoting(self):
+        rc, output = self._test_exec(False, None, "simple.sh", "function1", "a  b $(echo injected)")
+        self.assertEqual(rc, 0)
+        self.assertIn("function1 here a  b $(echo injected)", output)
+
+    def test_exec_args_not_seen_by_source(self):
+        test_file = os.path.join(self.temp_home_dir, "toplevel.sh")
+        with open(test_file, "w") as f:
+            f.write('echo "top level args: $#"\n[ "$1" = "-x" ] && shift\n')
+            f.write('f() {\n    echo "f args: $*"\n}\n')
+        rc, output = self._test_exec(False, None, test_file, "f", "-x", "y")
+        self.assertEqual(rc, 0)
+        self.assertIn("top level args: 0", output)
+        self.assertIn("f args: -x y", output)
+
+    def test_exec_no_args_nounset(self):
+        test_file = os.path.join(self.temp_home_dir, "nounset.sh")
+        with open(test_file, "w") as f:
+            f.write('set -euo pipefail\nf() {\n    echo "f args: $#"\n}\n')
+        rc, output = self._test_exec(False, None, test_file, "f")
+        self.assertEqual(rc, 0)
+        self.assertIn("f args: 0", output)
+
     def test_exec_rc_code(self):
         rc, output = self._test_exec(False, None, "moderate.sh", "i_shall_pass", "1")
         self.assertEqual(rc, 0)
@@ -171,6 +336,13 @@ class TestPybcli(unittest.TestCase):
         # TODO this assert shouldn't fail due to -e, but it does
         #self.assertNotIn("I shall not run", output)
 
+    def test_exec_rc_signal(self):
+        test_file = os.path.join(self.temp_home_dir, "signal.sh")
+        with open(test_file, "w") as f:
+            f.write('f() {\n    kill -TERM $$\n}\n')
+        rc, output = self._test_exec(False, None, test_file, "f")
+        self.assertEqual(rc, 128 + 15)
+
     def test_exec_with_includes(self):
         rc, output = self._test_exec(False, None, "test_includes.sh", "run_test")
         self.assertEqual(rc, 0)